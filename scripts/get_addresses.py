@@ -1,114 +1,268 @@
 import asyncio
-import aiohttp
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from huggingface_hub import HfApi
+import httpx
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+from huggingface_hub import HfApi, CommitOperationAdd, CommitOperationDelete
 import os
+import re
+import time
 import argparse
 
 # ULTRA-STEALTH CONFIGURATION
 CONCURRENT_REQUESTS = 10 
+TOTAL_RATE_LIMIT = 60  # OneMap requests per second across ALL parallel matrix jobs
+PARALLEL_JOBS = int(os.getenv("PARALLEL_JOBS", "1"))  # Scrapers sharing that budget
+RATE_LIMIT = TOTAL_RATE_LIMIT / PARALLEL_JOBS  # This process's share
+SUBRANGE_SIZE = 10000  # Pcodes per uploaded chunk file
 TOKEN = os.getenv("ONEMAP_TOKEN")
 HF_TOKEN = os.getenv("HF_TOKEN")
 REPO_ID = "gisfun/spatial-datasets"
+CHUNK_RE = re.compile(r"chunks/addresses_(\d{6})_(\d{6})\.parquet")
 
-async def fetch_pcode(pcode, session, semaphore):
-    async with semaphore:
-        page = 1
-        all_results = []
-        headers = {} # {"Authorization": TOKEN}
+# OneMap search result schema, accumulated column-by-column
+ADDRESS_FIELDS = (
+    "SEARCHVAL", "BLK_NO", "ROAD_NAME", "BUILDING", "ADDRESS",
+    "POSTAL", "X", "Y", "LATITUDE", "LONGITUDE",
+)
 
-        while True:
-            # 1.5s delay per page request to be absolutely safe
-            await asyncio.sleep(1.5) 
-            
-            # CORRECT ONEMAP URL
-            url = f"https://www.onemap.gov.sg/api/common/elastic/search?searchVal={pcode}&returnGeom=Y&getAddrDetails=Y&pageNum={page}"
-            
-            success = False
-            for attempt in range(4):
-                try:
-                    async with session.get(url, headers=headers, timeout=20) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            results = data.get("results", [])
-                            if results:
-                                all_results.extend(results)
-                            
-                            # Pagination logic
-                            if data.get("totalNumPages", 0) > page:
-                                page += 1
-                                success = True 
-                                break 
-                            else:
-                                return all_results 
-                        
-                        # LOG BLOCKING/THROTTLING IMMEDIATELY
-                        elif response.status in [401, 403, 429] or response.status >= 500:
-                            wait_time = (2 ** attempt) + 2
-                            print(f"⚠️ [PCODE {pcode}] OneMap Response: {response.status}. Retrying in {wait_time}s...", flush=True)
-                            await asyncio.sleep(wait_time)
-                        else:
-                            print(f"🛑 [PCODE {pcode}] Unexpected Status: {response.status}. Skipping.", flush=True)
-                            return all_results
-                except Exception as e:
-                    wait_time = (2 ** attempt) + 2
-                    print(f"❌ [PCODE {pcode}] Error: {str(e)[:100]}. Retrying in {wait_time}s...", flush=True)
-                    await asyncio.sleep(wait_time)
-            
-            if not success: 
-                break
-        return all_results
+# Resolved once per process rather than on every chunk written
+_WGS84 = CRS.from_epsg(4326)
+_WGS84_PROJJSON = _WGS84.to_json_dict()
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def to_float_array(values):
+    """OneMap sends coordinates as numeric strings; missing/garbled ones become NaN."""
+    return np.fromiter(map(_to_float, values), dtype=np.float64, count=len(values))
+
+def encode_point_wkb(lon, lat):
+    """Little-endian 2D WKB points (21 bytes each) built straight from the coordinate arrays."""
+    n = len(lon)
+    buf = np.empty((n, 21), dtype=np.uint8)
+    buf[:, 0] = 1  # byte order: little endian
+    buf[:, 1:5] = (1, 0, 0, 0)  # geometry type: Point
+    buf[:, 5:13] = np.ascontiguousarray(lon, dtype="<f8").view(np.uint8).reshape(n, 8)
+    buf[:, 13:21] = np.ascontiguousarray(lat, dtype="<f8").view(np.uint8).reshape(n, 8)
+    offsets = np.arange(0, 21 * (n + 1), 21, dtype=np.int32)
+    return pa.Array.from_buffers(pa.binary(), n, [None, pa.py_buffer(offsets), pa.py_buffer(buf)])
+
+def to_geoparquet_table(columns, lon, lat):
+    table = pa.table({**columns, "geometry": encode_point_wkb(lon, lat)})
+    # GeoParquet 1.0 column metadata, as geopandas would stamp it
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Point"],
+                "crs": _WGS84_PROJJSON,
+            }
+        },
+    }
+    return table.replace_schema_metadata({b"geo": orjson.dumps(geo)})
+
+class RateLimiter:
+    """Leaky bucket shared by all tasks: hands out evenly spaced request slots."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.last = 0.0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self.lock:
+            now = time.monotonic()
+            next_slot = max(now, self.last + self.interval)
+            self.last = next_slot
+        await asyncio.sleep(next_slot - now)
+
+    async def __aexit__(self, *exc):
+        return False
+
+async def fetch_page(pcode, page, client, limiter):
+    """GET one OneMap result page, retrying throttles/errors. Returns None when giving up."""
+    # CORRECT ONEMAP URL
+    url = f"https://www.onemap.gov.sg/api/common/elastic/search?searchVal={pcode}&returnGeom=Y&getAddrDetails=Y&pageNum={page}"
+    headers = {} # {"Authorization": TOKEN}
+
+    for attempt in range(4):
+        wait_time = (2 ** attempt) + 2
+        try:
+            async with limiter:
+                response = await client.get(url, headers=headers)
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+
+            # Only throttling and server errors are worth waiting out
+            if response.status_code != 429 and response.status_code < 500:
+                print(f"🛑 [PCODE {pcode}] Unexpected Status: {response.status_code}. Skipping.", flush=True)
+                return None
+            print(f"⚠️ [PCODE {pcode}] OneMap Response: {response.status_code}. Retrying in {wait_time}s...", flush=True)
+        except Exception as e:
+            print(f"❌ [PCODE {pcode}] Error: {str(e)[:100]}. Retrying in {wait_time}s...", flush=True)
+        await asyncio.sleep(wait_time)
+    return None
+
+async def fetch_pcode(pcode, client, limiter):
+    cols = {k: [] for k in ADDRESS_FIELDS}
+    page, total_pages, filled = 1, 1, 0
+
+    ok = True
+    while page <= total_pages:
+        data = await fetch_page(pcode, page, client, limiter)
+        if data is None:
+            ok = False
+            break
+        results = data.get("results", [])
+        if page == 1:
+            # First page reports the total hit count: size each column once
+            cols = {k: [None] * data.get("found", 0) for k in ADDRESS_FIELDS}
+        end = filled + len(results)
+        for k, col in cols.items():
+            col[filled:end] = [r.get(k) for r in results]
+        filled = end
+        total_pages = data.get("totalNumPages", 0)
+        page += 1
 
-async def process_range(start, end):
-    pcodes = [f"{p:06d}" for p in range(start, end + 1)]
-    semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
+    # Drop unfilled slots if pages came back short or a page failed
+    for col in cols.values():
+        del col[filled:]
+    return cols, ok
+
+async def process_range(start, end, client, limiter):
+    queue = asyncio.Queue()
+    for p in range(start, end + 1):
+        queue.put_nowait(f"{p:06d}")
     
-    results = []
-    connector = aiohttp.TCPConnector(limit=CONCURRENT_REQUESTS)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        tasks = [fetch_pcode(p, session, semaphore) for p in pcodes]
-        
-        count = 0
-        total = len(tasks)
-        for f in asyncio.as_completed(tasks):
-            res = await f
-            results.append(res)
+    columns = {k: [] for k in ADDRESS_FIELDS}
+    count = failed = 0
+    total = queue.qsize()
+
+    # A fixed pool of workers drains the queue instead of one task per pcode
+    async def worker():
+        nonlocal count, failed
+        while not queue.empty():
+            res, ok = await fetch_pcode(queue.get_nowait(), client, limiter)
+            for k, col in columns.items():
+                col.extend(res[k])
             count += 1
+            failed += not ok
             
             # Print every 50 for quick feedback in logs
             if count % 50 == 0 or count == total:
                 print(f"[{start:06d}-{end:06d}] Progress: {count:,}/{total:,} ({count/total*100:.1f}%)", flush=True)
+
+    await asyncio.gather(*(worker() for _ in range(CONCURRENT_REQUESTS)))
     
-    flattened = [b for sublist in results for b in sublist]
-    if not flattened: return None
-    
-    df = pd.DataFrame(flattened)
-    df['LATITUDE'] = pd.to_numeric(df['LATITUDE'], errors='coerce')
-    df['LONGITUDE'] = pd.to_numeric(df['LONGITUDE'], errors='coerce')
+    # A sub-range only counts as complete if no pcode gave up mid-fetch
+    complete = failed == 0
+    if not complete:
+        print(f"⚠️ [{start:06d}-{end:06d}] {failed:,} pcode(s) failed; range marked incomplete", flush=True)
+    if not columns["POSTAL"]: return None, complete
     
-    gdf = gpd.GeoDataFrame(
-        df, geometry=gpd.points_from_xy(df.LONGITUDE, df.LATITUDE), crs="EPSG:4326"
+    lat = columns['LATITUDE'] = to_float_array(columns['LATITUDE'])
+    lon = columns['LONGITUDE'] = to_float_array(columns['LONGITUDE'])
+    return to_geoparquet_table(columns, lon, lat), complete
+
+def flush_parquet_and_upload(table, fname):
+    # pyarrow dictionary-encodes every column by default; ZSTD shrinks the upload
+    pq.write_table(
+        table, fname,
+        compression="zstd", compression_level=5,
+        row_group_size=131072,
+    )
+    # LFS parts go up concurrently when HF_HUB_ENABLE_HF_TRANSFER=1 (hf_transfer)
+    HfApi().create_commit(
+        repo_id=REPO_ID, 
+        repo_type="dataset", 
+        operations=[CommitOperationAdd(path_in_repo=f"chunks/{fname}", path_or_fileobj=fname)],
+        commit_message=f"Upload chunks/{fname}",
+        token=HF_TOKEN
     )
-    return gdf
+
+def list_legacy_chunks(start, end):
+    """Chunk files overlapping [start, end] that aren't cells of the SUBRANGE_SIZE grid, by span."""
+    legacy = {}
+    for f in HfApi().list_repo_files(repo_id=REPO_ID, repo_type="dataset", token=HF_TOKEN):
+        m = CHUNK_RE.fullmatch(f)
+        if not m: continue
+        lo, hi = int(m[1]), int(m[2])
+        if lo <= end and hi >= start and (lo % SUBRANGE_SIZE or hi != lo + SUBRANGE_SIZE - 1):
+            legacy[f] = (lo, hi)
+    return legacy
+
+def delete_chunks(paths):
+    print(f"🧹 Removing {len(paths)} superseded chunk(s): {', '.join(paths)}", flush=True)
+    HfApi().create_commit(
+        repo_id=REPO_ID, 
+        repo_type="dataset", 
+        operations=[CommitOperationDelete(path_in_repo=f) for f in paths],
+        commit_message=f"Remove superseded {', '.join(paths)}",
+        token=HF_TOKEN
+    )
+
+async def main(start, end):
+    # Encode + upload each finished sub-range in a thread while the next one scrapes
+    uploads = []
+    # Grid cells (by lo) whose current data is fully published: uploaded, or
+    # scraped without failures and legitimately empty
+    covered = set()
+    legacy = await asyncio.to_thread(list_legacy_chunks, start, end)
+
+    async def prune():
+        # A legacy file goes only once every grid cell its span touches is covered
+        done = [
+            f for f, (a, b) in legacy.items()
+            if all(c in covered for c in range(a - a % SUBRANGE_SIZE, b + 1, SUBRANGE_SIZE))
+        ]
+        for f in done:
+            del legacy[f]
+        if done:
+            await asyncio.to_thread(delete_chunks, done)
+
+    async def publish(table, fname, lo, complete):
+        await asyncio.to_thread(flush_parquet_and_upload, table, fname)
+        if complete:
+            covered.add(lo)
+            await prune()
+
+    limiter = RateLimiter(RATE_LIMIT)
+    # One client for the whole run: HTTP/2 multiplexes every pcode GET over a
+    # handful of TLS connections, kept alive across sub-ranges
+    limits = httpx.Limits(
+        max_connections=CONCURRENT_REQUESTS,
+        max_keepalive_connections=CONCURRENT_REQUESTS,
+        keepalive_expiry=60,
+    )
+    async with httpx.AsyncClient(http2=True, timeout=20, limits=limits) as client:
+        for lo in range(start, end + 1, SUBRANGE_SIZE):
+            hi = min(lo + SUBRANGE_SIZE - 1, end)
+            table, complete = await process_range(lo, hi, client, limiter)
+            if table is not None:
+                fname = f"addresses_{lo:06d}_{hi:06d}.parquet"
+                uploads.append(asyncio.create_task(publish(table, fname, lo, complete)))
+            elif complete:
+                covered.add(lo)
+                uploads.append(asyncio.create_task(prune()))
+    await asyncio.gather(*uploads)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("start", type=int)
     parser.add_argument("end", type=int)
     args = parser.parse_args()
+    # Chunk files are cells of a fixed grid; an unaligned range would write
+    # files that overlap (and fight with) the neighbouring cells
+    if args.start % SUBRANGE_SIZE or (args.end + 1) % SUBRANGE_SIZE or args.end < args.start:
+        parser.error(f"start and end+1 must be multiples of {SUBRANGE_SIZE} (e.g. 0 99999)")
     
     print(f"🚀 Starting Ultra-Stealth Scrape: {args.start:06d} to {args.end:06d}")
-    gdf = asyncio.run(process_range(args.start, args.end))
-    
-    if gdf is not None and not gdf.empty:
-        fname = f"addresses_{args.start:06d}_{args.end:06d}.parquet"
-        gdf.to_parquet(fname, index=False)
-        HfApi().upload_file(
-            path_or_fileobj=fname, 
-            path_in_repo=f"chunks/{fname}",
-            repo_id=REPO_ID, 
-            repo_type="dataset", 
-            token=HF_TOKEN
-        )
+    asyncio.run(main(args.start, args.end))
@@ -1,39 +1,60 @@
-import pandas as pd
+import numpy as np
 import geopandas as gpd
-from shapely.geometry import Point
-import xml.etree.ElementTree as ET
-import requests
-from huggingface_hub import HfApi
+import shapely
+from pyproj import CRS
+from lxml import etree
+import httpx
+from huggingface_hub import HfApi, CommitOperationAdd
 import os
 
-# 1. Download and Parse XML
+_WGS84 = CRS.from_epsg(4326)
+
+# Compiled once, reused for every stop
+XP_LAT = etree.XPath('string(coordinates/lat)')
+XP_LON = etree.XPath('string(coordinates/long)')
+XP_DETAILS = etree.XPath('details')
+
+# 1. Stream the XML download straight into the parser
 url = "https://www.lta.gov.sg/map/busService/bus_stops.xml"
-response = requests.get(url)
-root = ET.fromstring(response.content)
-
-data = []
-for stop in root.findall('busstop'):
-    # Standardize data types
-    lat = float(stop.findtext('coordinates/lat'))
-    lon = float(stop.findtext('coordinates/long'))
-    
-    data.append({
-        "name": stop.get('name'),
-        "wab": stop.get('wab') == "true",
-        "details": stop.findtext('details'),
-        "geometry": Point(lon, lat)  # Create Shapely Point (Lon, Lat order!)
-    })
+parser = etree.XMLPullParser(events=('end',), tag='busstop')
+
+names, wab, details, lat, lon = [], [], [], [], []
+
+def drain():
+    for _, stop in parser.read_events():
+        names.append(stop.get('name'))
+        wab.append(stop.get('wab') == "true")
+        # Same as findtext('details'): None if missing, '' if empty, own text only
+        d = XP_DETAILS(stop)
+        details.append((d[0].text or '') if d else None)
+        lat.append(float(XP_LAT(stop)))
+        lon.append(float(XP_LON(stop)))
+        # Free the parsed stop and any siblings already consumed
+        stop.clear()
+        while stop.getprevious() is not None:
+            del stop.getparent()[0]
+
+with httpx.stream("GET", url, timeout=60, follow_redirects=True) as response:
+    response.raise_for_status()
+    for chunk in response.iter_bytes():
+        parser.feed(chunk)
+        drain()
+parser.close()
+drain()
 
 # 2. Convert to GeoDataFrame and save as GeoParquet
-gdf = gpd.GeoDataFrame(data, crs="EPSG:4326")
+geom = shapely.points(np.array(lon, dtype=np.float64), np.array(lat, dtype=np.float64))  # Lon, Lat order!
+gdf = gpd.GeoDataFrame(
+    {"name": names, "wab": np.array(wab, dtype=bool), "details": details}, geometry=geom, crs=_WGS84
+)
 gdf.to_parquet("bus_stops.parquet", index=False)
 
 # 3. Push to Hugging Face
 api = HfApi()
-api.upload_file(
-    path_or_fileobj="bus_stops.parquet",
-    path_in_repo="bus_stops.parquet",
+api.create_commit(
     repo_id="gisfun/spatial-datasets",
     repo_type="dataset",
+    operations=[CommitOperationAdd(path_in_repo="bus_stops.parquet", path_or_fileobj="bus_stops.parquet")],
+    commit_message="Upload bus_stops.parquet",
     token=os.environ["HF_TOKEN"]
 )